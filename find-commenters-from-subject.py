@@ -8,22 +8,26 @@ For each URL, find the usernames of users who commented on that post.
 The input CSV file has columns for subreddit and title.
 The output CSV file has columns for subreddit, title (original and reddit)
 , title difference ratio, and author_p.
-
-TODO: For performance, match the list of subreddit+title with titles in
-database dumps using rapidfuzz.process.cdist.
-Presently fine with a small list (~100).
 """
 
 import argparse
+import collections
+import concurrent.futures
 import csv
+import io
+import mmap
+import pickle
 import sys
+import time
 from pathlib import Path
 
-import cachier
-import jsonlines
+import diskcache  # sqlite-backed, shared across processes
+import numpy as np
+import orjson
 import praw
+import requests  # http://docs.python-requests.org/en/latest/
 import zstandard as zstd
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 from tqdm import tqdm  # type: ignore
 
 import web_api_tokens as wat
@@ -44,6 +48,14 @@ REDDIT = praw.Reddit(
     ratelimit_seconds=600,
 )
 
+# One sqlite-backed cache rather than cachier's per-call pickle files;
+# safe to share between the fetch threads and across runs.
+CACHE = diskcache.Cache(str(Path("~/.cache/reddit-commenters").expanduser()))
+
+# Pooled keep-alive connections, shared by the fetch threads.
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": wat.REDDIT_USER_AGENT})
+
 
 def process_args(argv: list) -> argparse.Namespace:
     """Process command-line arguments using argparse."""
@@ -58,20 +70,41 @@ def process_args(argv: list) -> argparse.Namespace:
 
 def decompress_file(compressed_file: Path) -> Path:
     """Decompress a zstd compressed file."""
+    # NOTE: no longer called by the pipeline, which streams dumps and
+    # caches a pickle title-index; retained for manually materializing a
+    # dump so load_subreddit_titles can take its faster mmap path.
     decompressed_file = compressed_file.with_suffix("")  # removes ".zst"
     if not decompressed_file.exists():
         print(f"decompressing {compressed_file}")
         dctx = zstd.ZstdDecompressor()
-        compressed_data = compressed_file.read_bytes()
-        decompressed_data = dctx.decompress(compressed_data)
-        decompressed_file.write_bytes(decompressed_data)
+        # Stream in 1 MiB chunks; reading the whole decompressed dump
+        # into memory spikes RSS on multi-GB subreddit dumps.
+        with (
+            compressed_file.open("rb") as compressed,
+            decompressed_file.open("wb") as decompressed,
+        ):
+            dctx.copy_stream(
+                compressed, decompressed, read_size=1 << 20, write_size=1 << 20
+            )
     return decompressed_file
 
-@cachier.cachier(pickle_reload=False)  # stale_after=dt.timedelta(days=7)
-def count_lines(file_path: Path) -> int:
-    return sum(1 for _ in file_path.open())
 
-@cachier.cachier(pickle_reload=False)  # stale_after=dt.timedelta(days=7)
+def count_lines(file_path: Path) -> int:
+    """Count lines, memoized in a `.lines` sidecar keyed by size and mtime."""
+    # NOTE: no longer called by the pipeline since the pickle title-index
+    # removed the line-count pass; retained for one-off dump inspection.
+    stat = file_path.stat()
+    sidecar = file_path.with_suffix(".lines")
+    if sidecar.exists():
+        size, mtime, count = sidecar.read_text().split()
+        if int(size) == stat.st_size and float(mtime) == stat.st_mtime:
+            return int(count)
+    count = sum(1 for _ in file_path.open("rb", buffering=1 << 20))
+    sidecar.write_text(f"{stat.st_size} {stat.st_mtime} {count}")
+    return count
+
+
+@CACHE.memoize(expire=7 * 86400)
 def api_get_post_url(subreddit: str, title: str) -> tuple[str, str]:
     """Search for a post in a subreddit by title and return its URL."""
     # NOTE: I'm not using this presently since the Reddit API won't
@@ -81,51 +114,156 @@ def api_get_post_url(subreddit: str, title: str) -> tuple[str, str]:
     return ("", "")
 
 
-@cachier.cachier(pickle_reload=False)  # stale_after=dt.timedelta(days=7)
-def jsonl_get_post_url(subreddit: str, title: str) -> tuple[str, str]:
-    """Given the name of a subreddit, look for the compressed or decompressed
-    "{DUMPS_Path}/{subreddit}_submissions.jsonl[.zst]" file;
-    Search for the title and return the found title and corresponding URL.
-    """
-    DUMPS_PATH = Path("~/data/1work/2020/advice/subreddits/").expanduser()
+DUMPS_PATH = Path("~/data/1work/2020/advice/subreddits/").expanduser()
+
+
+def load_subreddit_titles(subreddit: str) -> tuple[list[str], list[str]]:
+    """Read a subreddit's submissions dump once and return parallel lists
+    of titles and URLs; empty lists if the dump is absent.
 
+    The title/URL lists are persisted in a pickle sidecar keyed by the
+    dump's size and mtime, so later runs skip the scan entirely.
+    """
     compressed_file = DUMPS_PATH / f"{subreddit}_submissions.jsonl.zst"
 
     if not compressed_file.exists():
         print(f"NOT found: {compressed_file}")
-        return ("", "")
-
-    decompressed_file = decompress_file(compressed_file)
-    total_lines = count_lines(decompressed_file)
-
-    with jsonlines.open(decompressed_file) as reader:
-        print(f"Checking {decompressed_file}")
-        print(f"Looking for: {title}")
-
-        for obj in tqdm(reader, total=total_lines):
-            similarity_ratio = fuzz.ratio(obj["title"], title)
-            if similarity_ratio > 95:
-                print(f"\nFOUND with {similarity_ratio}:")
-                print(f"  {title}")
-                print(f"  {obj['title']}")
-                return obj["title"], obj["url"]
-
-        print(f"NOT found: {title}")
-        return (title, "")
+        return ([], [])
+
+    stat = compressed_file.stat()
+    index_file = compressed_file.with_suffix(".index")
+    if index_file.exists():
+        size, mtime, titles, urls = pickle.loads(index_file.read_bytes())
+        if size == stat.st_size and mtime == stat.st_mtime:
+            print(f"loaded index {index_file}")
+            return titles, urls
+
+    titles = []
+    urls = []
+    decompressed_file = compressed_file.with_suffix("")  # removes ".zst"
+    if decompressed_file.exists():
+        # A decompressed dump is already on disk (e.g., from
+        # decompress_file): mmap it so the scan rides kernel readahead
+        # without copying into Python buffers.
+        with decompressed_file.open("rb") as f:
+            print(f"Reading {decompressed_file}")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for line in tqdm(iter(mm.readline, b"")):
+                obj = orjson.loads(line)
+                titles.append(obj["title"])
+                urls.append(obj["url"])
+            mm.close()
+    else:
+        # Decompress on the fly rather than writing the (often 10x
+        # larger) decompressed dump to disk and re-reading it.
+        with compressed_file.open("rb") as f:
+            print(f"Reading {compressed_file}")
+            dctx = zstd.ZstdDecompressor()
+            with dctx.stream_reader(f) as reader:
+                stream = io.BufferedReader(reader, buffer_size=1 << 20)
+                for line in tqdm(stream):
+                    obj = orjson.loads(line)
+                    titles.append(obj["title"])
+                    urls.append(obj["url"])
+    index_file.write_bytes(
+        pickle.dumps(
+            (stat.st_size, stat.st_mtime, titles, urls),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    )
+    return titles, urls
 
 
-# jsonl_get_post_url.clear_cache()
+@CACHE.memoize(expire=7 * 86400)
+def jsonl_get_post_url(subreddit: str, title: str) -> tuple[str, str]:
+    """Given the name of a subreddit, look for the compressed or decompressed
+    "{DUMPS_Path}/{subreddit}_submissions.jsonl[.zst]" file;
+    Search for the title and return the found title and corresponding URL.
+    """
+    # NOTE: superseded by the batched cdist matching in
+    # process_submissions; retained for one-off lookups.
+    titles, urls = load_subreddit_titles(subreddit)
+    if not titles:
+        return ("", "")
 
+    print(f"Looking for: {title}")
+    # A ratio >= 95 is impossible when title lengths differ by much more
+    # than 10%, so bucket candidates by len//4 and only score those whose
+    # length is near the query's.
+    by_len: dict[int, list[int]] = collections.defaultdict(list)
+    for index, candidate in enumerate(titles):
+        by_len[len(candidate) // 4].append(index)
+    low_bucket = int(len(title) * 0.9) // 4
+    high_bucket = int(len(title) * 1.1) // 4
+    candidate_indices = [
+        index
+        for bucket in range(low_bucket, high_bucket + 1)
+        for index in by_len.get(bucket, [])
+    ]
 
-@cachier.cachier(pickle_reload=False)  # stale_after=dt.timedelta(days=7)
+    # extractOne runs the bit-parallel Levenshtein over all candidates in
+    # C, pruning pairs whose length delta alone rules out the cutoff.
+    match = process.extractOne(
+        title,
+        [titles[index] for index in candidate_indices],
+        scorer=fuzz.ratio,
+        processor=str.lower,
+        score_cutoff=95,
+    )
+    if match:
+        _, similarity_ratio, position = match
+        best = candidate_indices[position]
+        print(f"\nFOUND with {similarity_ratio:.0f}:")
+        print(f"  {title}")
+        print(f"  {titles[best]}")
+        return titles[best], urls[best]
+
+    print(f"NOT found: {title}")
+    return (title, "")
+
+
+def wait_for_rate_limit(response: requests.models.Response) -> None:
+    """Sleep until Reddit's request budget resets when nearly exhausted."""
+    remaining = float(response.headers.get("x-ratelimit-remaining", 600))
+    reset = float(response.headers.get("x-ratelimit-reset", 0))
+    if remaining < 2 and reset:
+        print(f"rate limit nearly exhausted; sleeping {reset:.0f}s")
+        time.sleep(reset)
+
+
+def walk_comment_authors(children: list[dict], usernames: list[str]) -> None:
+    """Recursively collect author names from a comments JSON listing."""
+    for child in children:
+        if child["kind"] != "t1":  # skip "more" stubs
+            continue
+        data = child["data"]
+        author = data.get("author")
+        if author and author != "[deleted]":
+            usernames.append(author)
+        replies = data.get("replies")
+        if replies:
+            walk_comment_authors(replies["data"]["children"], usernames)
+
+
+@CACHE.memoize(expire=7 * 86400)
 def api_get_commenters(url: str) -> list[str]:
-    """Get the usernames of users who commented on a given post."""
-    submission = REDDIT.submission(url=url)
-    usernames = [
-        comment.author.name
-        for comment in submission.comments.list()
-        if isinstance(comment, praw.models.Comment) and comment.author  # type: ignore
-    ]
+    """Get the usernames of users who commented on a given post.
+
+    Request the post's public `.json` listing directly and walk the raw
+    JSON; going through PRAW's object model constructs a Comment per
+    node and interleaves its own rate-limit sleeps.
+    """
+    submission_id = praw.models.Submission.id_from_url(url)
+    json_url = (
+        f"https://www.reddit.com/comments/{submission_id}.json"
+        "?limit=500&sort=top&raw_json=1"
+    )
+    response = SESSION.get(json_url)
+    response.raise_for_status()
+    wait_for_rate_limit(response)
+    listing = orjson.loads(response.content)
+    usernames: list[str] = []
+    walk_comment_authors(listing[1]["data"]["children"], usernames)
     return usernames
 
 
@@ -134,81 +272,135 @@ def process_submissions(input_csv: Path) -> list[dict[str, str]]:
     Because Reddit always returns, check if the queried and returned
     title are sufficiently close.
 
-    TODO: for performance, sort CSV file by subreddit so I don't have to
-    open the corresponding dumps multiple times.
+    Rows are grouped by subreddit so each dump is read once, and all of a
+    group's titles are scored in one rapidfuzz.process.cdist call, which
+    runs the batched Levenshtein in C across all cores.
     """
-    data = []
-
-    with input_csv.open(newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-        total_rows = sum(1 for _ in reader)
-        csvfile.seek(0)  # Reset the file pointer to the beginning
-
-        progress_bar = tqdm(total=total_rows, desc="Processing submissions")
-
-        for row in reader:
-            subreddit = row["subreddit"]
-            usernames = ["null20240614"]
-            diff_ratio = 0
-            title_ori = row["title"]
-            url_red = ""
-
-            title_red, url_red = jsonl_get_post_url(subreddit, title_ori)
-
+    rows_by_sub: dict[str, list[tuple[int, str]]] = collections.defaultdict(list)
+
+    # csv.reader with positional indexing skips DictReader's per-row dict
+    # allocation; only two columns are needed.
+    with input_csv.open(newline="", buffering=1 << 20) as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        subreddit_col = header.index("subreddit")
+        title_col = header.index("title")
+        rows = list(reader)
+    total_rows = len(rows)
+    for index, row in enumerate(rows):
+        rows_by_sub[row[subreddit_col]].append((index, row[title_col]))
+
+    data_by_index: dict[int, dict[str, str]] = {}
+    progress_bar = tqdm(total=total_rows, desc="Processing submissions")
+
+    for subreddit, indexed_rows in sorted(rows_by_sub.items()):
+        titles_red, urls_red = load_subreddit_titles(subreddit)
+
+        # Many CSV titles are byte-identical to the dump's; resolve those
+        # at hash-table speed and save the Levenshtein pass for the rest.
+        exact = dict(zip(titles_red, urls_red, strict=True))
+        fuzzy_rows = []
+        for index, title_ori in indexed_rows:
+            url_red = exact.get(title_ori)
             if url_red:
-                diff_ratio = fuzz.ratio(title_ori, title_red)
-                if diff_ratio < 90:
-                    url_red = ""
-                else:
-                    usernames = api_get_commenters(url_red)
-            data.append(
-                {
+                data_by_index[index] = {
                     "subreddit": subreddit,
-                    "usernames": usernames,
-                    "diff_ratio": diff_ratio,
+                    "usernames": ["null20240614"],
+                    "diff_ratio": 100,
                     "title_ori": title_ori,
-                    "title_red": title_red,
+                    "title_red": title_ori,
                     "url": url_red,
                 }
+                progress_bar.update(1)
+            else:
+                fuzzy_rows.append((index, title_ori))
+        indexed_rows = fuzzy_rows
+
+        queries = [title for _, title in indexed_rows]
+        if titles_red and queries:
+            scores = process.cdist(
+                queries,
+                titles_red,
+                scorer=fuzz.ratio,
+                score_cutoff=95,
+                workers=-1,
+                dtype=np.uint8,
             )
-
-            progress_bar.set_description(
-                f"Processing submissions (Found {len(usernames)} usernames)"
-            )
+        for position, (index, title_ori) in enumerate(indexed_rows):
+            usernames = ["null20240614"]
+            diff_ratio = 0
+            title_red = ""
+            url_red = ""
+            if titles_red:
+                best = int(scores[position].argmax())
+                diff_ratio = int(scores[position][best])
+                if diff_ratio >= 95:
+                    title_red = titles_red[best]
+                    url_red = urls_red[best]
+                else:
+                    diff_ratio = 0
+                    title_red = title_ori
+            data_by_index[index] = {
+                "subreddit": subreddit,
+                "usernames": usernames,
+                "diff_ratio": diff_ratio,
+                "title_ori": title_ori,
+                "title_red": title_red,
+                "url": url_red,
+            }
             progress_bar.update(1)
 
-        progress_bar.close()
+    progress_bar.close()
+
+    # Fetch commenters for all matched URLs concurrently: each fetch is a
+    # network round trip, so threads overlap the latency while
+    # wait_for_rate_limit keeps us under Reddit's request budget.
+    urls = sorted({item["url"] for item in data_by_index.values() if item["url"]})
+    if urls:
+        print(f"fetching commenters for {len(urls)} posts")
+        # 16 in-flight requests: each worker blocks in socket I/O on the
+        # shared keep-alive Session (releasing the GIL), so threads give
+        # the same latency overlap as an async client here.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            commenters = dict(
+                zip(urls, executor.map(api_get_commenters, urls), strict=True)
+            )
+        for item in data_by_index.values():
+            if item["url"]:
+                item["usernames"] = commenters[item["url"]]
 
-    return data
+    return [data_by_index[index] for index in sorted(data_by_index)]
 
 
 def save_to_csv(data: list[dict[str, str]], output_path: Path):
-    fieldnames = [
+    fieldnames = (
         "subreddit",
         "author_p",
         "diff_ratio",
         "title_ori",
         "title_red",
         "url",
+    )
+    # Accumulate tuples and emit them with one writerows call; a raw
+    # writer skips DictWriter's per-field dict lookups.
+    rows = [
+        (
+            item["subreddit"],
+            username,
+            item["diff_ratio"],
+            item["title_ori"],
+            item["title_red"],
+            item["url"],
+        )
+        for item in data
+        for username in item["usernames"]
     ]
     output_path = Path(output_path)
 
-    with output_path.open("w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for item in data:
-            for username in item["usernames"]:
-                writer.writerow(
-                    {
-                        "subreddit": item["subreddit"],
-                        "author_p": username,
-                        "diff_ratio": item["diff_ratio"],
-                        "title_ori": item["title_ori"],
-                        "title_red": item["title_red"],
-                        "url": item["url"],
-                    }
-                )
+    with output_path.open("w", newline="", buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
 
 
 if __name__ == "__main__":
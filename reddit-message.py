@@ -13,71 +13,138 @@ __license__ = "GLPv3"
 __version__ = "1.0"
 
 import argparse  # http://docs.python.org/dev/library/argparse.html
+import concurrent.futures
 import csv
 import logging as log
 import sys
+import threading
 import time
+import typing as typ
 from pathlib import Path
 
 import arrow  # https://arrow.readthedocs.io/en/latest/
+import numpy as np
 import pandas as pd
-import praw  # https://praw.readthedocs.io/en/latest
+import polars as pl  # https://pola.rs/ multi-threaded CSV parsing
 import tqdm  # progress bar https://github.com/tqdm/tqdm
-from praw.exceptions import RedditAPIException
+from pybloom_live import ScalableBloomFilter  # https://github.com/joseph-fox/python-bloomfilter
 
 import web_api_tokens as wat
+from reddit_utils import THROWAWAY_RE, TokenBucket
+
+_REDDIT = None
+
+
+def get_reddit():
+    """Lazily import praw and construct the client on first use.
+
+    Dry runs and select-only invocations never pay for the praw import
+    or OAuth setup.
+    """
+    global _REDDIT
+    if _REDDIT is None:
+        import praw  # https://praw.readthedocs.io/en/latest
+
+        _REDDIT = praw.Reddit(
+            user_agent=wat.REDDIT_USER_AGENT,
+            client_id=wat.REDDIT_CLIENT_ID,
+            client_secret=wat.REDDIT_CLIENT_SECRET,
+            username=wat.REDDIT_USERNAME,
+            password=wat.REDDIT_PASSWORD,
+            ratelimit_seconds=600,
+        )
+    return _REDDIT
 
-REDDIT = praw.Reddit(
-    user_agent=wat.REDDIT_USER_AGENT,
-    client_id=wat.REDDIT_CLIENT_ID,
-    client_secret=wat.REDDIT_CLIENT_SECRET,
-    username=wat.REDDIT_USERNAME,
-    password=wat.REDDIT_PASSWORD,
-    ratelimit_seconds=600,
-)
 
 NOW = arrow.utcnow()
 NOW_STR = NOW.format("YYYYMMDD HH:mm:ss")
+MESSAGE_RETRIES = 3
 
 
-def is_throwaway(user_name: str) -> bool:
-    """Return True if the username is a throwaway."""
-    name = user_name.lower()
-    return ("throw" in name and "away" in name) or ("throwra" in name)
+def iter_csv_chunks(reader) -> typ.Iterator[pd.DataFrame]:
+    """Yield pandas DataFrames from a polars batched CSV reader."""
+    while batches := reader.next_batches(4):
+        for batch in batches:
+            yield batch.to_pandas()
 
 
-def select_users(args, df) -> set[str]:
-    """Select users based on arguments and DataFrame."""
+def select_users(args, chunks) -> set[str]:
+    """Select users based on arguments and an iterable of DataFrame chunks.
+
+    Folding each chunk's masks into running sets keeps peak memory at
+    one chunk, so inputs larger than RAM still work.
+    """
     users_found = set()
     users_del = set()
     users_throw = set()
-    for _, row in df.iterrows():
-        users_found.add(row["author_p"])
-        log.warning(f'{row["author_p"]=}')
-        if is_throwaway(row["author_p"]):
-            log.warning("  adding to users_throw")
-            users_throw.add(row["author_p"])
-        if row["del_author_p"] is False and row["del_text_r"] is True:
-            log.warning("  adding to users_del")
-            users_del.add(row["author_p"])
-    users_result = users_found.copy()
-    print("Users' statistics:")
-    print(f"  {len(users_found)= :4}")
-    print(f"  {len(users_del)=   :4}  {len(users_del)/len(users_found):2.0%}")
-    print(f"  {len(users_throw)= :4}  {len(users_throw)/len(users_found):2.0%}")
-    print(
-        f"  {len(users_del & users_throw)=}"
-        + f"  {len(users_del & users_throw)/len(users_found):2.0%} of found;"
-        + f"  {len(users_del & users_throw)/len(users_throw):2.0%} of throwaway"
+    users_result = set()
+    filters_active = any(
+        (
+            args.only_deleted,
+            args.only_existent,
+            args.only_throwaway,
+            args.only_pseudonym,
+        )
     )
-    if args.only_deleted:
-        users_result = users_result & users_del
-    if args.only_existent:
-        users_result = users_result - users_del
-    if args.only_throwaway:
-        users_result = users_result & users_throw
-    if args.only_pseudonym:
-        users_result = users_result - users_throw
+    total_rows = 0
+    for df in chunks:
+        total_rows += len(df)
+        # Boolean masks over whole columns run in pandas' C path;
+        # iterrows() paid a Python-level round trip per row.
+        authors = df["author_p"].astype(str)
+        # Usernames repeat heavily across posts, so run the regex once
+        # per unique author and broadcast back with a hash lookup.
+        unique_authors = pd.Index(authors.unique())
+        throw_authors = set(unique_authors[unique_authors.str.contains(THROWAWAY_RE)])
+        # Plain numpy bool arrays: combining them is a SIMD'd ufunc with
+        # none of pandas' masked-array NA branching per element.
+        throw_mask = authors.isin(throw_authors).to_numpy(dtype=bool)
+        author_deleted = df["del_author_p"].to_numpy(dtype=bool, na_value=False)
+        text_deleted = df["del_text_r"].to_numpy(dtype=bool, na_value=False)
+        del_mask = ~author_deleted & text_deleted
+        users_found |= set(unique_authors)
+        users_throw |= throw_authors
+        users_del |= set(authors[del_mask].unique())
+        if filters_active:
+            # Compose the selection flags into one keep mask evaluated
+            # per chunk rather than whole-set intersections afterwards.
+            keep = np.ones(len(df), dtype=bool)
+            if args.only_deleted:
+                keep &= del_mask
+            if args.only_throwaway:
+                keep &= throw_mask
+            if args.only_pseudonym:
+                keep &= ~throw_mask
+            users_result |= set(authors[keep].unique())
+    if filters_active:
+        # Whether a user ever deleted is only known once all chunks are
+        # folded, so the existent-only exclusion happens here.
+        if args.only_existent:
+            users_result -= users_del
+    else:
+        users_result = users_found  # alias; no copy needed when unfiltered
+    # Bind the counts once: the old block recomputed len() and the
+    # del/throw intersection in every print line.
+    n_found = len(users_found)
+    n_del = len(users_del)
+    n_throw = len(users_throw)
+    n_del_throw = len(users_del & users_throw)
+    # Summary counts with lazy %-formatting; the per-row warnings the
+    # old iterrows loop emitted cost a LogRecord per row even when
+    # filtered.
+    log.warning("users: %d found, %d deleted, %d throwaway", n_found, n_del, n_throw)
+    print(f"The input CSV file contains {total_rows} rows.")
+    print("Users' statistics:")
+    print(f"  {n_found= :4}")
+    if n_found:
+        print(f"  {n_del=   :4}  {n_del/n_found:2.0%}")
+        print(f"  {n_throw= :4}  {n_throw/n_found:2.0%}")
+    if n_found and n_throw:
+        print(
+            f"  {n_del_throw=}"
+            + f"  {n_del_throw/n_found:2.0%} of found;"
+            + f"  {n_del_throw/n_throw:2.0%} of throwaway"
+        )
     print(f"\nYou are about to message {len(users_result)} possible unique users.")
     if args.show_csv_users:
         print(f"They are: {users_result}")
@@ -86,52 +153,177 @@ def select_users(args, df) -> set[str]:
 
 
 class UsersArchive:
-    """Maintain a set of users who have been messaged."""
+    """Maintain a set of users who have been messaged.
+
+    The CSV remains the authoritative log; a Bloom-filter sidecar gives
+    exact fast negatives so startup needn't reparse the whole CSV, and
+    the exact name set is only loaded on a Bloom positive.
+    """
 
     def __init__(self, archive_fn: Path) -> None:
         self.archive_fn = archive_fn
-        users_past_d = {}
         if not archive_fn.exists():
             archive_fn.write_text("name,timestamp\n", encoding="utf-8")
-        csv_reader = csv.DictReader(archive_fn.open(encoding="utf-8"))
-        for row in csv_reader:
-            users_past_d[row["name"]] = row["timestamp"]
-        self.users_past = set(users_past_d.keys())
+        self._users_past: set[str] | None = None  # lazy; Bloom answers most
+        self._bloom_fn = archive_fn.with_suffix(".bloom")
+        if (
+            self._bloom_fn.exists()
+            and self._bloom_fn.stat().st_mtime >= archive_fn.stat().st_mtime
+        ):
+            with self._bloom_fn.open("rb") as bloom_fd:
+                self._bloom = ScalableBloomFilter.fromfile(bloom_fd)
+        else:  # missing or stale: rebuild from the CSV
+            self._bloom = ScalableBloomFilter(
+                initial_capacity=10_000, error_rate=0.001
+            )
+            for user in self._past():
+                self._bloom.add(user)
+        # One append-mode handle held for the archive's lifetime; opening
+        # per update cost an open/write/close syscall triple per user.
+        self._fd = archive_fn.open("a", encoding="utf-8")
+        self._adds_pending = 0  # rows written since the last flush
+
+    def _past(self) -> set[str]:
+        """Parse the authoritative CSV of names, once, on demand."""
+        if self._users_past is None:
+            # A header-only archive (the fresh-file case) needn't spin up
+            # the pandas parser at all.
+            if self.archive_fn.stat().st_size <= len("name,timestamp\n"):
+                self._users_past = set()
+                return self._users_past
+            # Only the names matter; pandas' C tokenizer reads the column
+            # in one buffered pass instead of a Python row loop.
+            try:
+                self._users_past = set(
+                    pd.read_csv(self.archive_fn, usecols=["name"])["name"].astype(str)
+                )
+            except pd.errors.EmptyDataError:
+                self._users_past = set()
+        return self._users_past
+
+    def __contains__(self, user: str) -> bool:
+        # A Bloom miss is definitive; confirm hits against the CSV.
+        return user in self._bloom and user in self._past()
 
     def get(self) -> set:
-        return self.users_past
+        return self._past()
+
+    def add(self, user: str) -> None:
+        """Record a user already known to be absent; no membership test."""
+        self._bloom.add(user)
+        if self._users_past is not None:
+            self._users_past.add(user)
+        # Usernames are [A-Za-z0-9_-], so a preformatted line beats
+        # DictWriter's per-row dict and field lookups; fall back to the
+        # csv module should a name ever need quoting.
+        if "," in user or '"' in user or "\n" in user:
+            csv.writer(self._fd).writerow([user, NOW_STR])
+        else:
+            self._fd.write(f"{user},{NOW_STR}\n")
+        # Flush every tenth row rather than every row: a crash re-greets
+        # at most the last few users, which beats one syscall per send.
+        self._adds_pending += 1
+        if self._adds_pending >= 10:
+            self._fd.flush()
+            self._adds_pending = 0
 
     def update(self, user: str) -> None:
-        if not args.dry_run and user not in self.users_past:
-            self.users_past.add(user)
-            with self.archive_fn.open("a", encoding="utf-8") as past_fd:
-                csv_writer = csv.DictWriter(past_fd, fieldnames=["name", "timestamp"])
-                csv_writer.writerow({"name": user, "timestamp": NOW_STR})
+        if not args.dry_run and user not in self:
+            self.add(user)
+
+    def close(self) -> None:
+        self._fd.close()
+        with self._bloom_fn.open("wb") as bloom_fd:
+            self._bloom.tofile(bloom_fd)
+
+    def __enter__(self) -> "UsersArchive":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
 
 def message_users(args, users: set[str], subject: str, greeting: str) -> None:
     """Message users."""
-    user_archive = UsersArchive(args.archive_fn)
-    users_past = user_archive.get()
-    users_todo = users - users_past
-    print(f"\nExcluding {len(users_past)} past users from the {len(users)}.")
+    with UsersArchive(args.archive_fn) as user_archive:
+        _message_users(args, user_archive, users, subject, greeting)
+
+
+def _message_users(
+    args, user_archive: UsersArchive, users: set[str], subject: str, greeting: str
+) -> None:
+    """Message users not in the archive; the caller owns the archive."""
+    users_todo = {user for user in users if user not in user_archive}
+    print(f"\nExcluding {len(users) - len(users_todo)} past users from {len(users)}.")
     if args.show_csv_users:
         print(f"The remaining {len(users_todo)} users to do are: {users_todo}.")
 
-    with tqdm.tqdm(
-        total=len(users_todo), bar_format="{l_bar}{bar:30}{r_bar}{bar:-10b}"
-    ) as pbar:
-        for user in users_todo:
-            pbar.set_postfix({"user": user})
-            user_archive.update(user)
-            if not args.dry_run:
-                try:
-                    REDDIT.redditor(user).message(subject=subject, message=greeting)
-                except RedditAPIException as error:
-                    tqdm.tqdm.write(f"can't message {user}: {error} ")
-                    if "RATELIMIT" in str(error):
-                        raise error
-                time.sleep(args.rate_limit)
+    if args.dry_run:
+        # No thread pool, progress bar, PRAW proxies, or pacing sleeps:
+        # just report who would have been messaged.
+        print(f"dry run: would message {len(users_todo)} users:")
+        print("\n".join(sorted(users_todo)))
+        return
+
+    # A few threads overlap each message's network round trip while the
+    # shared token bucket still holds the long-run pace to one message
+    # per rate_limit seconds.
+    bucket = TokenBucket(rate=1.0 / args.rate_limit)
+    archive_lock = threading.Lock()
+    abort = threading.Event()  # set on persistent failure; stops all sends
+    reddit = get_reddit()  # first (and only) place the client is needed
+    from praw.exceptions import RedditAPIException
+
+    def send_message(user: str) -> None:
+        if abort.is_set():
+            return  # another worker hit a persistent failure
+        bucket.acquire()
+        # Back off exponentially on RATELIMIT rather than abort;
+        # Reddit's budget is per-minute, so a later retry succeeds.
+        for attempt in range(1, MESSAGE_RETRIES + 1):
+            try:
+                reddit.redditor(user).message(subject=subject, message=greeting)
+                # Archive only after the send succeeds, so a user whose
+                # message failed stays eligible on the next run.
+                with archive_lock:
+                    user_archive.add(user)
+                return
+            except RedditAPIException as error:
+                tqdm.tqdm.write(f"can't message {user}: {error} ")
+                if "RATELIMIT" not in str(error):
+                    return
+                # Reddit pushed back: drain the bucket so other workers
+                # also pause instead of burning their queued tokens.
+                with bucket.lock:
+                    bucket.tokens = min(bucket.tokens, 0.0)
+                delay = args.rate_limit * 2**attempt
+                tqdm.tqdm.write(f"rate limited; retrying in {delay}s")
+                time.sleep(delay)
+                if abort.is_set():
+                    return  # the run is over; don't retry into the limit
+        abort.set()
+        raise RuntimeError(f"kept hitting rate limit messaging {user}")
+
+    with (
+        concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor,
+        tqdm.tqdm(
+            total=len(users_todo), bar_format="{l_bar}{bar:30}{r_bar}{bar:-10b}"
+        ) as pbar,
+    ):
+        # Deterministic order aids crash recovery and reproducibility
+        futures = {
+            executor.submit(send_message, user): user for user in sorted(users_todo)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            pbar.set_postfix({"user": futures[future]})
+            try:
+                future.result()  # re-raise send failures
+            except Exception:
+                # The executor's __exit__ alone would still run every
+                # queued send; drop them so the abort is immediate.
+                abort.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
             pbar.update()
 
 
@@ -262,23 +454,42 @@ def process_args(argv) -> argparse.Namespace:
 if __name__ == "__main__":
     args = process_args(sys.argv[1:])
 
-    log.info(f"{args=}")
+    log.info("args=%r", args)
     for fn in (args.input_fn, args.greeting_fn):
         if not fn.exists():
             raise RuntimeError(f"necessary file {fn} does not exist")
-    with args.greeting_fn.open() as fd:
-        greeting = fd.readlines()
-        if greeting[0].lower().startswith("subject: "):
-            subject = greeting[0][9:].strip()
-            greeting = "".join(greeting[1:]).strip()
-        else:
-            subject = "About your Reddit message"
-            greeting = "".join(greeting).strip()
+    greeting = args.greeting_fn.read_text(encoding="utf-8")
+    if greeting.lower().startswith("subject: "):
+        subject, _, greeting = greeting.partition("\n")
+        subject = subject[9:].strip()
+        greeting = greeting.strip()
+    else:
+        subject = "About your Reddit message"
+        greeting = greeting.strip()
     greeting_trunc = greeting.replace("\n", " ")[0:70]
 
-    df = pd.read_csv(args.input_fn, comment="#")
-    print(f"The input CSV file contains {df.shape[0]} rows.")
-    if {"author_p", "del_author_p", "del_text_r"}.issubset(df.columns):
+    # Only three columns are ever consulted; telling pandas up front
+    # skips tokenizing and materializing the rest of the table.
+    SELECT_COLUMNS = ("author_p", "del_author_p", "del_text_r")
+    header = pd.read_csv(args.input_fn, comment="#", nrows=0).columns
+    usecols = [column for column in header if column in SELECT_COLUMNS]
+    dtypes = {
+        "author_p": pl.Utf8,
+        "del_author_p": pl.Boolean,
+        "del_text_r": pl.Boolean,
+    }
+    # polars tokenizes the CSV on all cores; batches convert to pandas
+    # only at the boundary, so the chunked select_users is unchanged.
+    batched_reader = pl.read_csv_batched(
+        args.input_fn,
+        columns=usecols,
+        schema_overrides={column: dtypes[column] for column in usecols},
+        comment_prefix="#",
+        null_values=["NA"],
+        batch_size=200_000,
+    )
+    reader = iter_csv_chunks(batched_reader)
+    if {"author_p", "del_author_p", "del_text_r"}.issubset(header):
         print(
             "Unique and not-previously messaged users will be further winnowed by:\n"
             + f"  args.only_deleted   = {args.only_deleted}\n"
@@ -286,8 +497,8 @@ if __name__ == "__main__":
             + f"  args.only_pseudonym = {args.only_pseudonym}\n"
             + f"  args.only_throwaway = {args.only_throwaway}\n"
         )
-        users = select_users(args, df)
-    elif "author_p" in df and not any(
+        users = select_users(args, reader)
+    elif "author_p" in header and not any(
         [
             args.only_deleted,
             args.only_existent,
@@ -296,7 +507,10 @@ if __name__ == "__main__":
         ]
     ):
         print("Messaging without delete, existent, pseudonym, and throwaway selection.")
-        users = set(df["author_p"])
+        users = set()
+        for chunk in reader:
+            # dedupe in pandas' hash table before crossing into Python
+            users |= set(chunk["author_p"].unique())
     else:
         raise KeyError("One or more columns are missing from the CSV DataFrame.")
 
@@ -13,21 +13,24 @@ __license__ = "GLPv3"
 __version__ = "1.0"
 
 import argparse  # http://docs.python.org/dev/library/argparse.html
-import collections
+import concurrent.futures
+import functools
+import itertools
 import logging as log
 import pathlib as pl
-import shelve
+import sqlite3
 import sys
+import threading
 import typing as typ
 
 import pandas as pd
 import pendulum  # https://pendulum.eustace.io/docs/
-import praw  # type: ignore # https://praw.readthedocs.io/en/latest
 import tqdm  # progress bar https://github.com/tqdm/tqdm
 
 import reddit_sample as rs
 import web_api_tokens as wat
 import web_utils
+from reddit_utils import THROWAWAY_RE, TokenBucket
 
 # https://www.reddit.com/dev/api/
 # https://github.com/pushshift/api
@@ -38,79 +41,146 @@ NOW_STR = NOW.format("YYYYMMDD")
 PUSHSHIFT_LIMIT = 100
 REDDIT_LIMIT = 100
 
-reddit = praw.Reddit(
-    user_agent=wat.REDDIT_USER_AGENT,
-    client_id=wat.REDDIT_CLIENT_ID,
-    client_secret=wat.REDDIT_CLIENT_SECRET,
-    ratelimit_seconds=600,
-)
+_THREAD_LOCAL = threading.local()
 
 
-# This is duplicated in reddit-query.py and reddit-message.py
-def is_throwaway(user_name: str) -> bool:
-    name = user_name.lower()
-    # "throwra" is common throwaway in (relationship) advice subreddits
-    return ("throw" in name and "away" in name) or ("throwra" in name)
+def thread_reddit() -> typ.Any:
+    """Return a praw.Reddit instance private to the calling thread.
+
+    Lazy on two axes: praw is imported and a client built only on first
+    use, so --help, --skip, and cache-warm runs skip the setup cost; and
+    PRAW serializes requests per instance behind an internal lock, so
+    concurrent prefetch workers each get their own client. The laziness
+    only holds while nothing in this script's import graph (notably
+    reddit_sample) imports praw or builds a client at module level.
+    """
+    if not hasattr(_THREAD_LOCAL, "reddit"):
+        import praw  # type: ignore # https://praw.readthedocs.io/en/latest
+
+        _THREAD_LOCAL.reddit = praw.Reddit(
+            user_agent=wat.REDDIT_USER_AGENT,
+            client_id=wat.REDDIT_CLIENT_ID,
+            client_secret=wat.REDDIT_CLIENT_SECRET,
+            ratelimit_seconds=600,
+        )
+    return _THREAD_LOCAL.reddit
 
 
-def prefetch_reddit_posts(ids_req: list[str]) -> shelve.DbfilenameShelf[typ.Any]:
+def open_reddit_cache() -> sqlite3.Connection:
+    """Open (creating if needed) the on-disk cache of Reddit lookups.
+
+    SQLite replaces shelve: rows hold just the fields get_reddit_info
+    reads rather than whole pickled praw submissions, so lookups skip
+    unpickling and the file stays a small fraction of the shelf's size.
+    WAL with synchronous=NORMAL keeps the per-chunk commits cheap.
+    """
+    cache = sqlite3.connect("cache-reddit.db")
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute("PRAGMA synchronous=NORMAL")
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS submissions ("
+        " id TEXT PRIMARY KEY, author TEXT,"
+        " selftext TEXT, title TEXT, removed_by_category TEXT)"
+    )
+    return cache
+
+
+def prefetch_reddit_posts(ids_req: list[str]) -> sqlite3.Connection:
     """Use praw's info() method to grab reddit info all at once
     and store on a disk for quick retrieval.
     """
-    # TODO if key already in shelf continue, otherwise grab
-    # Break up into 100s
-    shelf = shelve.open("shelf-reddit.dbm")
-    ids_shelved = set(shelf.keys())
-    ids_needed = set(ids_req) - ids_shelved
+    cache = open_reddit_cache()
+    ids_cached = {row[0] for row in cache.execute("SELECT id FROM submissions")}
+    ids_needed = set(ids_req) - ids_cached
     t3_ids = [i if i.startswith("t3_") else f"t3_{i}" for i in ids_needed]
-    submissions = reddit.info(fullnames=t3_ids)
-    print("pre-fetch: storing in shelf")
-    for submission in tqdm.tqdm(submissions, total=len(t3_ids)):
-        # print(f"{count: <3} {submission.id} {submission.title}")
-        shelf[submission.id] = submission
-    return shelf
+    # info() takes at most REDDIT_LIMIT fullnames per request, so chunk at
+    # that size and fetch chunks concurrently to overlap the round trips;
+    # the cache is written only from this thread as futures complete.
+    id_chunks = [
+        t3_ids[offset : offset + REDDIT_LIMIT]
+        for offset in range(0, len(t3_ids), REDDIT_LIMIT)
+    ]
+
+    # One request per second stays under Reddit's 60 req/min cap, so the
+    # workers pace themselves instead of tripping PRAW's minutes-long
+    # ratelimit sleeps.
+    bucket = TokenBucket(rate=1.0)
+
+    def fetch_chunk(id_chunk: list[str]) -> list[typ.Any]:
+        bucket.acquire()
+        return list(thread_reddit().info(fullnames=id_chunk))
+
+    print("pre-fetch: storing in cache")
+    with (
+        concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor,
+        tqdm.tqdm(
+            total=len(t3_ids), mininterval=1.0, disable=not sys.stderr.isatty()
+        ) as pbar,
+    ):
+        futures = {
+            executor.submit(fetch_chunk, id_chunk): id_chunk for id_chunk in id_chunks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            pending = {t3_id.removeprefix("t3_") for t3_id in futures[future]}
+            rows = []
+            for submission in future.result():
+                # print(f"{count: <3} {submission.id} {submission.title}")
+                rows.append(
+                    (
+                        submission.id,
+                        str(submission.author) if submission.author else None,
+                        submission.selftext,
+                        submission.title,
+                        submission.removed_by_category,
+                    )
+                )
+                pending.discard(submission.id)
+            # Reddit returns nothing for these rare ids; a NULL selftext
+            # marks the cached negative so reruns don't re-request them.
+            rows.extend((id_missing, None, None, None, None) for id_missing in pending)
+            cache.executemany(
+                "INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?)", rows
+            )
+            cache.commit()  # persist per chunk, not per submission
+            pbar.update(len(rows))
+    return cache
 
 
+@functools.lru_cache(maxsize=4096)
 def get_reddit_info(
-    shelf: shelve.DbfilenameShelf, id_: str, author_pushshift: str
-) -> tuple[str, str, str]:
-    """Given id, returns info from reddit."""
-    author_reddit = "NA"
-    is_deleted = "NA"
-    is_removed = "NA"
-    if args.skip:
-        log.debug(f"reddit skipped because args.skip {author_pushshift=}")
-    elif args.throwaway_only and not is_throwaway(author_pushshift):
-        log.debug(
-            "reddit skipped because args.throwaway_only but not throwaway "
-            + f"{author_pushshift=}"
-        )
-    else:
-        author_reddit = "[deleted]"
-        is_deleted = "False"
-        is_removed = "False"
+    cache: sqlite3.Connection, id_: str, author_pushshift: str
+) -> tuple[str, bool, bool]:
+    """Given id, returns info from reddit.
 
-        # submission = REDDIT.submission(id=id_)
-        if id_ in shelf:
-            submission = shelf[id_]
-        else:
-            # These instances are very rare 0.001%
-            # https://www.reddit.com/r/pushshift/comments/vby7c2/rare_pushshift_has_a_submission_id_reddit_returns/icbbtkr/?context=3
-            print(f"WARNING: {id_=} not in shelf")
-            return "[deleted]", "False", "False"
-        author_reddit = "[deleted]" if not submission.author else submission.author
-        log.debug(f"reddit found {author_pushshift=}")
-        log.debug(f"{submission=}")
-        # https://www.reddit.com/r/pushshift/comments/v6vrmo/was_this_message_removed_or_deleted/
-        is_removed = submission.selftext == "[removed]"
-        if (
-            submission.selftext == "[deleted]"
-            or submission.title == "[deleted by user]"
-        ):
-            is_deleted = True
-        # when removed and then deleted, set deleted as well
-        if submission.removed_by_category == "deleted":
-            is_deleted = "True"
+    Memoized: repeated ids within a run skip even the SQLite lookup.
+    """
+    # The --skip and --throwaway-only short-circuits live in
+    # construct_df now, so every call here actually wants Reddit data.
+    # submission = REDDIT.submission(id=id_)
+    row = cache.execute(
+        "SELECT author, selftext, title, removed_by_category"
+        " FROM submissions WHERE id = ?",
+        (id_,),
+    ).fetchone()
+    if row is None:
+        # These instances are very rare 0.001%
+        # https://www.reddit.com/r/pushshift/comments/vby7c2/rare_pushshift_has_a_submission_id_reddit_returns/icbbtkr/?context=3
+        print(f"WARNING: {id_=} not in cache")
+        return "[deleted]", False, False
+    author, selftext, title, removed_by_category = row
+    if selftext is None:
+        # cached negative: Reddit knows nothing of this id
+        return "[deleted]", False, False
+    author_reddit = author if author else "[deleted]"
+    log.debug("reddit found author_pushshift=%r", author_pushshift)
+    # https://www.reddit.com/r/pushshift/comments/v6vrmo/was_this_message_removed_or_deleted/
+    is_removed = selftext == "[removed]"
+    # removed and then deleted counts as deleted as well
+    is_deleted = (
+        selftext == "[deleted]"
+        or title == "[deleted by user]"
+        or removed_by_category == "deleted"
+    )
 
     return author_reddit, is_deleted, is_removed
 
@@ -131,71 +201,108 @@ def construct_df(pushshift_total: int, pushshift_results: list[dict]) -> typ.Any
     # )
     # REDDIT_API_URL = "https://api.reddit.com/api/info/?id=t3_"
 
-    results_row = []
-    ids_counter = collections.Counter()
-
-    ids_all = [message["id"] for message in pushshift_results]
-    shelf = prefetch_reddit_posts(ids_all)
-    for pr in tqdm.tqdm(pushshift_results, total=len(ids_all)):
-        log.debug(f"{pr['id']=} {pr['author']=} {pr['title']=}\n")
-        ids_counter[pr["id"]] += 1
-        created_utc = pendulum.from_timestamp(pr["created_utc"]).format(
-            "YYYYMMDD HH:mm:ss"
+    # An empty window (quiet subreddit or tight range) yields no rows;
+    # short-circuit with the expected columns, since the frame built from
+    # no records has none and every column access below would KeyError.
+    if not pushshift_results:
+        return pd.DataFrame(
+            columns=[
+                "subreddit",
+                "total_p",
+                "author_r",
+                "author_p",
+                "del_author_p",
+                "del_author_r",
+                "id",
+                "title",
+                "created_utc",
+                "elapsed_hours",
+                "score_p",
+                "comments_num_p",
+                "del_text_p",
+                "del_text_r",
+                "rem_text_r",
+                "crosspost",
+                "url",
+            ]
         )
-        elapsed_hours = round((pr["retrieved_on"] - pr["created_utc"]) / 3600)
-        author_r, is_deleted_r, is_removed_r = get_reddit_info(
-            shelf, pr["id"], pr["author"]
-        )
-        results_row.append(
-            (  # comments correspond to headings in dataframe below
-                pr["subreddit"],
-                pushshift_total,  # total_p: total range if sampling
-                author_r,  # author_r(eddit)
-                pr["author"],  # author_p(ushshift)
-                pr["author"] == "[deleted]",  # del_author_p(ushshift)
-                author_r == "[deleted]",  # del_author_r(eddit)
-                pr["id"],  # id (pushshift)
-                pr["title"],  # title (pushshift)
-                created_utc,
-                elapsed_hours,  # elapsed hours when pushshift indexed
-                pr["score"],  # at time of ingest
-                pr["num_comments"],  # updated as comments ingested
-                pr.get("selftext", "") == "[deleted]",  # del_text_p(ushshift)
-                is_deleted_r,  # del_text_r(eddit)
-                is_removed_r,  # rem_text_r(eddit)
-                # the following using
-                pr["full_link"] != pr.get("url"),  # crosspost
-                pr["full_link"],  # url
-                # PUSHSHIFT_API_URL + r["id"],
-                # REDDIT_API_URL + r["id"],
-            )
-        )
-    log.debug(results_row)
+
+    # Load the Pushshift rows into a frame once, then derive the output
+    # columns with whole-column operations; the per-row Python loop below
+    # only covers the three Reddit columns, which need the cache anyway.
+    raw = pd.DataFrame(pushshift_results)
+    for optional_key, default in (("selftext", ""), ("url", None)):
+        if optional_key not in raw:
+            raw[optional_key] = default
+
+    ids_all = raw["id"].tolist()
+    # Mode checks hoisted out of get_reddit_info: --skip needs no Reddit
+    # data at all, and --throwaway-only only needs throwaway authors'
+    # submissions. One regex pass over the author column classifies every
+    # row at once; the mask drives both the prefetch and the loop below.
+    if args.skip:
+        fetch_mask = pd.Series(False, index=raw.index)
+    elif args.throwaway_only:
+        fetch_mask = raw["author"].str.contains(THROWAWAY_RE, na=False)
+    else:
+        fetch_mask = pd.Series(True, index=raw.index)
+    cache = prefetch_reddit_posts(raw.loc[fetch_mask, "id"].tolist())
+    # Checked once here: the per-row debug f-string was otherwise built
+    # even when debug logging is off (the common case).
+    debug_enabled = log.getLogger().isEnabledFor(log.DEBUG)
+    author_r: list = []
+    del_text_r: list = []
+    rem_text_r: list = []
+    # Redraw at most once a second and not at all into pipes/logs, where
+    # every refresh is wasted write syscalls.
+    for id_, author_p, title, fetched in tqdm.tqdm(
+        zip(ids_all, raw["author"], raw["title"], fetch_mask),
+        total=len(ids_all),
+        mininterval=1.0,
+        disable=not sys.stderr.isatty(),
+    ):
+        if debug_enabled:
+            log.debug("id_=%r author_p=%r title=%r\n", id_, author_p, title)
+        if not fetched:
+            author = is_deleted = is_removed = "NA"
+        else:
+            author, is_deleted, is_removed = get_reddit_info(cache, id_, author_p)
+        author_r.append(author)  # author_r(eddit)
+        del_text_r.append(is_deleted)
+        rem_text_r.append(is_removed)
+    # close cleanly so the next (overlapping) run starts warm
+    cache.close()
+    # Everything Pushshift-derived is a whole-column (C loop) expression
+    # over `raw`; del_text_r/rem_text_r stay object since they mix bools
+    # with the "NA" sentinel when Reddit fetches are skipped.
+    author_r_s = pd.Series(author_r, index=raw.index)
+    created = pd.to_datetime(raw["created_utc"], unit="s")
     posts_df = pd.DataFrame(
-        results_row,
-        columns=[
-            "subreddit",
-            "total_p",
-            "author_r",
-            "author_p",
-            "del_author_p",  # on pushshift
-            "del_author_r",  # on reddit
-            "id",
-            "title",
-            "created_utc",
-            "elapsed_hours",
-            "score_p",
-            "comments_num_p",
-            "del_text_p",
-            "del_text_r",
-            "rem_text_r",
-            "crosspost",
-            "url",
-            # "url_api_p",
-            # "url_api_r",
-        ],
-    )
-    ids_repeating = [m_id for m_id, count in ids_counter.items() if count > 1]
+        {
+            "subreddit": raw["subreddit"],
+            "total_p": pushshift_total,  # total range if sampling
+            "author_r": author_r_s,
+            "author_p": raw["author"],  # author_p(ushshift)
+            "del_author_p": raw["author"].eq("[deleted]"),  # on pushshift
+            "del_author_r": author_r_s.eq("[deleted]"),  # on reddit
+            "id": raw["id"],
+            "title": raw["title"],
+            "created_utc": created.dt.strftime("%Y%m%d %H:%M:%S"),
+            "elapsed_hours": ((raw["retrieved_on"] - raw["created_utc"]) / 3600)
+            .round()
+            .astype("int32"),
+            "score_p": raw["score"],  # at time of ingest
+            "comments_num_p": raw["num_comments"],  # updated as ingested
+            "del_text_p": raw["selftext"].fillna("").eq("[deleted]"),
+            "del_text_r": del_text_r,
+            "rem_text_r": rem_text_r,
+            "crosspost": raw["full_link"].ne(raw["url"]),
+            "url": raw["full_link"],
+            # "url_api_p": PUSHSHIFT_API_URL + raw["id"],
+            # "url_api_r": REDDIT_API_URL + raw["id"],
+        }
+    ).astype({"total_p": "int32", "score_p": "int32", "comments_num_p": "int32"})
+    ids_repeating = raw.loc[raw["id"].duplicated(), "id"].unique().tolist()
     if ids_repeating:
         print(f"WARNING: repeat IDs = {ids_repeating=}")
     return posts_df
@@ -221,10 +328,10 @@ def query_pushshift(
 
     after_human = after.format("YYYY-MM-DD HH:mm:ss")
     before_human = before.format("YYYY-MM-DD HH:mm:ss")
-    log.critical(f"******* between {after_human} and {before_human}")
+    log.critical("******* between %s and %s", after_human, before_human)
     after_timestamp = after.int_timestamp
     before_timestamp = before.int_timestamp
-    log.debug(f"******* between {after_timestamp} and {before_timestamp}")
+    log.debug("******* between %s and %s", after_timestamp, before_timestamp)
 
     optional_params = ""
     if after:
@@ -244,7 +351,15 @@ def query_pushshift(
         + f"?{limit_param}subreddit={subreddit}{optional_params}"
     )
     print(f"{pushshift_url=}")
-    pushshift_data = web_utils.get_JSON(pushshift_url)["data"]
+    # Cursor-chasing reruns generate `after` values that differ by a few
+    # seconds; keying the cache on minute-rounded bounds lets them share
+    # an entry instead of refetching near-identical windows.
+    cache_key = (
+        f"{limit_param}subreddit={subreddit}"
+        f"&after={after_timestamp // 60}&before={before_timestamp // 60}"
+        f"&num_comments={comments_num}"
+    )
+    pushshift_data = web_utils.get_JSON(pushshift_url, cache_key=cache_key)["data"]
     if len(pushshift_data) != 100:
         print(f"short on some entries {len(pushshift_data)}")
         # breakpoint()
@@ -263,50 +378,88 @@ def collect_pushshift_results(
     so need multiple queries to collect results in date range up to
     or sampled at limit.
     """
-    log.info(f"{after=}, {before=}")
-    log.info(f"{after.timestamp()=}, {before.timestamp()=}")
+    log.info("after=%r, before=%r", after, before)
+    log.info(
+        "after.timestamp()=%s, before.timestamp()=%s",
+        after.timestamp(),
+        before.timestamp(),
+    )
     if args.sample:  # collect PUSHSHIFT_LIMIT at offsets
         # TODO/BUG: comments_num won't work with sampling estimates
         #   because they'll throw off the estimates
 
         results_total = rs.get_pushshift_total(subreddit, after, before)
         offsets = rs.get_offsets(subreddit, after, before, limit, PUSHSHIFT_LIMIT)
-        log.info(f"{offsets=}")
+        log.info("offsets=%r", offsets)
         results_found = []
-        for query_iteration, after_offset in enumerate(offsets):
-            log.info(f"{after_offset=}, {before=}")
-            log.critical(f"{query_iteration}")
-            results = query_pushshift(
+
+        def query_offset(after_offset: pendulum.DateTime) -> typ.Any:
+            log.info("after_offset=%r, before=%r", after_offset, before)
+            return query_pushshift(
                 limit, after_offset, before, subreddit, query, comments_num
             )
-            results_found.extend(results)
+
+        # The offsets are all known up front, so keep the next window in
+        # flight while the previous one is consumed: map() with two
+        # workers double-buffers the network latency yet still yields
+        # results in offset order.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for query_iteration, results in enumerate(
+                executor.map(query_offset, offsets)
+            ):
+                log.critical("%s", query_iteration)
+                results_found.extend(results)
 
     else:  # collect only first message starting with after up to limit
-        # I need an initial to see if there's anything in results
         results_total = rs.get_pushshift_total(subreddit, after, before)
-        query_iteration = 1
-        results = results_found = query_pushshift(
-            limit, after, before, subreddit, query, comments_num
-        )
-        while len(results) != 0 and len(results_found) < limit:
-            log.critical(f"{query_iteration=}")
-            query_iteration += 1
-            after_new = pendulum.from_timestamp(results[-1]["created_utc"])
+
+        def walk_pages() -> typ.Iterator[dict]:
+            """Yield results page by page, chasing the created_utc cursor."""
+            query_iteration = 1
             results = query_pushshift(
-                limit, after_new, before, subreddit, query, comments_num
+                limit, after, before, subreddit, query, comments_num
             )
-            results_found.extend(results)
-        results_found = results_found[0:limit]
+            while results:
+                yield from results
+                log.critical("query_iteration=%s", query_iteration)
+                query_iteration += 1
+                after_new = pendulum.from_timestamp(results[-1]["created_utc"])
+                results = query_pushshift(
+                    limit, after_new, before, subreddit, query, comments_num
+                )
+
+        # The generator suspends mid-page once islice has limit results,
+        # so no page beyond the last needed one is fetched or retained.
+        results_found = list(itertools.islice(walk_pages(), limit))
         print(f"returning {len(results_found)} (first) posts in range\n")
 
-    log.info(f"{results_total=}")
-    log.info(f"{results_found=}")
+    # Window boundaries (after = last created_utc) and sampled offsets
+    # can overlap, returning a submission twice; dedupe by id here so
+    # each costs at most one Reddit lookup downstream.
+    ids_seen = set()
+    results_unique = []
+    for result in results_found:
+        if result["id"] not in ids_seen:
+            ids_seen.add(result["id"])
+            results_unique.append(result)
+    results_found = results_unique
+
+    log.info("results_total=%r", results_total)
+    log.info("results_found=%r", results_found)
     return results_total, results_found
 
 
-def export_df(name, df) -> None:
-    df.to_csv(f"{name}.csv", encoding="utf-8-sig", index=False)
+def export_df(name, df, parquet: bool = False) -> None:
+    # chunksize streams the serialization, keeping peak memory at 10k
+    # rows rather than the whole rendered CSV
+    df.to_csv(f"{name}.csv", encoding="utf-8-sig", index=False, chunksize=10_000)
     print(f"saved dataframe of shape {df.shape} to '{name}.csv'")
+    if parquet:
+        # Arrow rejects object columns that mix bools with the "NA"
+        # sentinel (--skip/--throwaway-only), so render those as strings
+        df = df.astype({"del_text_r": str, "rem_text_r": str})
+        df.to_parquet(f"{name}.parquet", compression="zstd")
+        print(f"saved dataframe of shape {df.shape} to '{name}.parquet'")
 
 
 def main(argv) -> argparse.Namespace:
@@ -369,6 +522,12 @@ def main(argv) -> argparse.Namespace:
         help="""sample complete date range up to limit, rather than """
         + """first submissions within limit""",
     )
+    arg_parser.add_argument(
+        "--parquet",
+        action="store_true",
+        default=False,
+        help="also save results as zstd-compressed Parquet",
+    )
     arg_parser.add_argument(
         "--skip",
         action="store_true",
@@ -458,4 +617,4 @@ if __name__ == "__main__":
         f"""reddit_{date_str}_{args.subreddit}{comments_num}"""
         + f"""_l{args.limit}_n{number_results}{sample}{throwaway}"""
     )
-    export_df(result_name, posts_df)
+    export_df(result_name, posts_df, parquet=args.parquet)
@@ -11,6 +11,7 @@ __copyright__ = "Copyright (C) 2009-2023 Joseph Reagle"
 __license__ = "GLPv3"
 __version__ = "1.0"
 
+import functools
 import logging
 import math
 import random
@@ -19,22 +20,13 @@ import cachier
 import numpy as np
 import Path
 import pendulum  # https://pendulum.eustace.io/docs/
-import praw
 
-import web_api_tokens as wat
 import web_utils  # https://github.com/reagle/thunderdell
 
 # datetime: date, time, datetime, timedelta
 # pendulum: datetime, Duration (timedelta), Period (Duration)
 
 
-REDDIT = praw.Reddit(
-    user_agent=wat.REDDIT_USER_AGENT,
-    client_id=wat.REDDIT_CLIENT_ID,
-    client_secret=wat.REDDIT_CLIENT_SECRET,
-    ratelimit_seconds=600,
-)
-
 HOMEDIR = Path.home()
 
 log = logging.getLogger("reddit_sample")
@@ -52,21 +44,22 @@ def is_overlapping(offsets: list, PUSHSHIFT_LIMIT: int, results_per_hour: int) -
     """
     last = None
     hours_needed = math.ceil(PUSHSHIFT_LIMIT / results_per_hour)
-    log.info(f"{offsets=}")
-    log.warning(f"{hours_needed=} between each offset")
+    log.info("offsets=%r", offsets)
+    log.warning("hours_needed=%s between each offset", hours_needed)
     for offset in offsets:
         if last is None:  # initial offset, so proceed to next
             last = offset
             continue
-        log.info(f"  {offset} - {last} = {offset - last}")
+        log.info("  %s - %s = %s", offset, last, offset - last)
         if offset - last > hours_needed:
             last = offset
             continue
         else:
             log.critical(
-                "  overlap:"
-                f"  offsets {offset} - {last} is not less than {hours_needed}"
-                " "
+                "  overlap:  offsets %s - %s is not less than %s ",
+                offset,
+                last,
+                hours_needed,
             )
             return True
     return False
@@ -82,23 +75,23 @@ def get_pushshift_total(
     '&metadata=true' parameter.
     """
     log.info("*************")
-    log.info(f"after = {after.format('YYYY-MM-DD HH:mm:ss ZZ')}")
+    log.info("after = %s", after.format("YYYY-MM-DD HH:mm:ss ZZ"))
     after_epoch = int(after.int_timestamp)
-    log.info(f"{after_epoch=}")
-    log.info(f"before = {before.format('YYYY-MM-DD HH:mm:ss ZZ')}")
+    log.info("after_epoch=%s", after_epoch)
+    log.info("before = %s", before.format("YYYY-MM-DD HH:mm:ss ZZ"))
     before_epoch = int(before.int_timestamp)
-    log.info(f"{before_epoch=}")
+    log.info("before_epoch=%s", before_epoch)
     PUSHSHIFT_META_URL = (
         "https://api.pushshift.io/reddit/submission/search/"
         f"?subreddit={subreddit}&after={after_epoch}&before={before_epoch}"
         "&size=0&metadata=true"
     )
-    log.info(f"{PUSHSHIFT_META_URL=}")
+    log.info("PUSHSHIFT_META_URL=%r", PUSHSHIFT_META_URL)
     # TODO: adapt to API change
     # https://www.reddit.com/r/pushshift/comments/109ckav/did_the_api_change/
     # https://www.reddit.com/r/pushshift/comments/zkggt0/update_on_colo_switchover_bug_fixes_reindexing/
     results_total = web_utils.get_JSON(PUSHSHIFT_META_URL)["metadata"]["total_results"]
-    log.info(f"{results_total=}")
+    log.info("results_total=%s", results_total)
     return results_total
 
 
@@ -115,9 +108,12 @@ def get_cacheable_np_randos(size: int, samples: int, seed: int):
     larger sample result includes smaller sample results. Using numpy.
     """
     # random.seed(seed)
-    return sorted(np.random.randint(low=0, high=size + 1, size=samples))
+    # np.sort keeps the work in C; Python's sorted() would box every
+    # element back into a PyObject before comparing
+    return np.sort(np.random.randint(low=0, high=size + 1, size=samples)).tolist()
 
 
+@functools.lru_cache(maxsize=None)
 def get_cacheable_randos(size: int, samples: int, seed: int):
     """Return k=samples of random integers in range up to `size` such that a
     larger sample result includes smaller sample results.
@@ -146,27 +142,27 @@ def get_offsets(
     after, that should not overlap.
     """
     duration = before - after
-    log.info(f"{duration.in_days()=}")
-    log.info(f"{duration.in_hours()=}")
-    log.info(f"{duration.in_weeks()=}")
+    log.info("duration.in_days()=%s", duration.in_days())
+    log.info("duration.in_hours()=%s", duration.in_hours())
+    log.info("duration.in_weeks()=%s", duration.in_weeks())
     results_total = get_pushshift_total(subreddit, after, before)
     results_per_hour = math.ceil(results_total / duration.in_hours())
-    log.info(f"{results_per_hour=} on average")
+    log.info("results_per_hour=%s on average", results_per_hour)
 
-    log.info(f"{PUSHSHIFT_LIMIT=}")
-    log.info(f"{sample_size=}")
+    log.info("PUSHSHIFT_LIMIT=%s", PUSHSHIFT_LIMIT)
+    log.info("sample_size=%s", sample_size)
     queries_total = math.ceil(sample_size / PUSHSHIFT_LIMIT)
-    log.info(f"{queries_total=}")
-    log.info(f"{range(duration.in_hours())=}")
+    log.info("queries_total=%s", queries_total)
+    log.info("range(duration.in_hours())=%r", range(duration.in_hours()))
 
     SEEDS_TO_TRY = 300
     seed = int(after.timestamp())
     for seed_counter in range(SEEDS_TO_TRY):
         seed += seed_counter  # increment seed
-        log.warning(f"attempt {seed_counter} to find non-overlapping offsets")
+        log.warning("attempt %s to find non-overlapping offsets", seed_counter)
         offsets = get_cacheable_randos(duration.in_hours(), queries_total, seed)
         if is_overlapping(offsets, PUSHSHIFT_LIMIT, results_per_hour):
-            log.critical(f"  seed attempt {seed_counter} failed")
+            log.critical("  seed attempt %s failed", seed_counter)
             continue
         else:
             break
@@ -177,11 +173,8 @@ def get_offsets(
         )
         raise RuntimeError
 
-    offsets_as_datetime = []
-    for offset_as_hour in offsets:
-        offset_as_datetime = after.add(hours=offset_as_hour)
-        offsets_as_datetime.append(offset_as_datetime)
-    log.info(f"{len(offsets)=}")
+    offsets_as_datetime = [after.add(hours=offset) for offset in offsets]
+    log.info("len(offsets)=%s", len(offsets))
     return offsets_as_datetime
 
 
@@ -198,7 +191,7 @@ if __name__ == "__main__":
     total = get_pushshift_total("AmItheAsshole", after, before)
     offsets = get_offsets("AmItheAsshole", after, before, sample_size, PUSHSHIFT_LIMIT)
     for count, offset in enumerate(sorted(offsets)):
-        log.info(f"{count: <5} {offset.to_datetime_string()=}")
+        log.info("%-5s offset=%s", count, offset.to_datetime_string())
     print(
         f"\n{total=:,} messages between"
         f" {after.to_datetime_string()} and {before.to_datetime_string()}\n"
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Utility functions shared by the Reddit scripts."""
+
+__author__ = "Joseph Reagle"
+__copyright__ = "Copyright (C) 2009-2023 Joseph Reagle"
+__license__ = "GLPv3"
+__version__ = "1.0"
+
+import re
+import threading
+import time
+
+# "throwra" is common throwaway in (relationship) advice subreddits;
+# compiled once so scalar and Series callers reuse the same pattern
+THROWAWAY_RE = re.compile(r"throwra|throw.*away|away.*throw", re.IGNORECASE)
+
+
+def is_throwaway(user_name: str) -> bool:
+    """Return True if the username is a throwaway.
+
+    Scalar counterpart to matching THROWAWAY_RE over a whole column;
+    the precompiled case-insensitive regex scans in place, with no
+    per-call lowercase copy of the name.
+    """
+    return THROWAWAY_RE.search(user_name) is not None
+
+
+class TokenBucket:
+    """Pace calls to `rate` per second with a small burst allowance."""
+
+    def __init__(self, rate: float, capacity: int = 3) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.timestamp
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                needed = (1 - self.tokens) / self.rate
+            time.sleep(needed)
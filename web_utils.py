@@ -7,10 +7,12 @@ __license__ = "GLPv3"
 __version__ = "1.0"
 
 import contextlib as cl
+import functools
+import hashlib
 import html.entities
-import json
 import logging
 import os
+import pathlib
 import re
 import time
 from typing import Any
@@ -18,14 +20,68 @@ from xml.sax import saxutils
 
 import cachier
 import lxml
+import orjson  # https://github.com/ijl/orjson
 import Path
 import requests  # http://docs.python-requests.org/en/latest/
+import zstandard  # https://github.com/indygreg/python-zstandard
 
 HOMEDIR = Path.home()
 
 
 log = logging.getLogger("web_utils")
 
+# One keep-alive session shared by the fetchers below: paginated queries
+# (e.g., Pushshift) reuse the socket instead of paying a fresh TCP/TLS
+# handshake per request.
+SESSION = requests.Session()
+# enough pooled connections for the concurrent fetchers in the scripts;
+# transient failures (Pushshift 429s, gateway hiccups) retry with
+# exponential backoff at the transport layer instead of surfacing
+_RETRY = requests.adapters.Retry(
+    total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+)
+_ADAPTER = requests.adapters.HTTPAdapter(pool_maxsize=16, max_retries=_RETRY)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
+
+
+def url_cache(ttl_days: int = 7):
+    """Cache a JSON-returning fetcher on disk, keyed by a hash of its URL.
+
+    Callers can pass `cache_key` to override the URL as the key, e.g. to
+    normalize jittery query parameters so near-identical requests share
+    an entry. Entries are zstd-compressed JSON rather than pickle:
+    ~5-10x fewer bytes on disk and orjson reloads them in one pass.
+    Entries expire after `ttl_days`.
+    """
+    cache_dir = pathlib.Path("~/.cache/reddit-web").expanduser()
+    ttl_seconds = ttl_days * 24 * 60 * 60
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(url: str, *args, cache_key: str | None = None, **kwargs):
+            key = cache_key if cache_key else url
+            cache_fn = cache_dir / (
+                hashlib.blake2b(key.encode("utf-8")).hexdigest() + ".json.zst"
+            )
+            if (
+                cache_fn.exists()
+                and time.time() - cache_fn.stat().st_mtime < ttl_seconds
+            ):
+                compressed = cache_fn.read_bytes()
+                decompressed = zstandard.ZstdDecompressor().decompress(compressed)
+                return orjson.loads(decompressed)
+            result = func(url, *args, **kwargs)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            cache_fn.write_bytes(
+                zstandard.ZstdCompressor().compress(orjson.dumps(result))
+            )
+            return result
+
+        return wrapper
+
+    return decorator
+
 
 def escape_XML(text: str) -> str:  # http://wiki.python.org/moin/EscapingXml
     """Escape XML character entities; & < > are defaulted."""
@@ -74,7 +130,7 @@ def get_HTML(
     time.sleep(rate_limit)
 
     AGENT_HEADERS = {"User-Agent": "MacOS:reddit-query.py:v0.5 (by /u/reagle-reseach)"}
-    r = requests.get(url, headers=AGENT_HEADERS, verify=True)
+    r = SESSION.get(url, headers=AGENT_HEADERS, verify=True)
     # info(f"{r.headers['content-type']=}")
     if "html" in r.headers["content-type"]:
         HTML_bytes = r.content
@@ -91,7 +147,7 @@ def get_HTML(
     return HTML_bytes, HTML_parsed, HTML_unicode, r
 
 
-@cachier.cachier(pickle_reload=False)  # stale_after=dt.timedelta(days=7)
+@url_cache(ttl_days=7)
 def get_JSON(
     url: str,
     referer: str = "",
@@ -112,22 +168,24 @@ def get_JSON(
 
     # TODO: put limiter here? https://github.com/shaypal5/cachier/issues/65
     AGENT_HEADERS = {"User-Agent": "Reddit Tools https://github.com/reagle/reddit/"}
-    log.info(f"{url=}")
-    # TODO: use a HTTPAdapter with max_retires
-    # https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks/#retry-on-failure
+    log.info("url=%r", url)
 
     try:
-        r = requests.get(url, headers=AGENT_HEADERS, verify=True)
+        r = SESSION.get(url, headers=AGENT_HEADERS, verify=True)
         r.raise_for_status()
     except requests.exceptions.RequestException as err:
-        log.critical(f"{err=} -- waiting 5 minutes, try again, quit if fail")
+        log.critical("err=%r -- waiting 5 minutes, try again, quit if fail", err)
         time.sleep(300)  # wait 5 minutes
-        r = requests.get(url, headers=AGENT_HEADERS, verify=True)
+        r = SESSION.get(url, headers=AGENT_HEADERS, verify=True)
         r.raise_for_status()
     returned_content_type = r.headers["content-type"].split(";")[0]
-    log.info(f"{requested_content_type=} == {returned_content_type=}?")
+    log.info(
+        "requested_content_type=%r == returned_content_type=%r?",
+        requested_content_type,
+        returned_content_type,
+    )
     if requested_content_type == returned_content_type:
-        json_content = json.loads(r.content)
+        json_content = orjson.loads(r.content)
         return json_content
     else:
         raise OSError("URL content is not JSON.")